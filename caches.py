@@ -0,0 +1,36 @@
+"""Disk-backed caches for rate-limited API results.
+
+Custom Search responses and Gemini verdicts are stable enough to reuse
+across runs, so re-runs (the common case after a partial failure) skip
+the API latency and the quota cost entirely.
+"""
+import hashlib
+import json
+import os
+
+import diskcache
+
+CACHE_DIR = '.cache'
+
+search_cache = diskcache.Cache(os.path.join(CACHE_DIR, 'search'))
+verdict_cache = diskcache.Cache(os.path.join(CACHE_DIR, 'verdicts'))
+
+# Search results drift as the web changes; cap how long a cached response
+# is served so a stale result set eventually refreshes on its own
+SEARCH_CACHE_TTL = 7 * 24 * 3600
+
+def params_key(params):
+    """Stable cache key for a dict of request parameters"""
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def file_fingerprint(path, chunk_size=4096):
+    """Cheap content hash of a file: size plus its first and last 4KB"""
+    h = hashlib.sha1()
+    size = os.path.getsize(path)
+    h.update(str(size).encode())
+    with open(path, 'rb') as f:
+        h.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(chunk_size, size - chunk_size))
+            h.update(f.read(chunk_size))
+    return h.hexdigest()
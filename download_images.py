@@ -1,8 +1,16 @@
-import json
+import asyncio
+import multiprocessing
 import os
-import requests
+import pickle
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+import aiohttp
 from dotenv import load_dotenv
+from caches import search_cache, params_key, SEARCH_CACHE_TTL
+from file_utils import link_or_copy
+from http_session import SESSION, REQUEST_EXCEPTIONS, headers_preclude_image, retry_after_seconds
+from keyword_filters import filter_keywords, load_keywords
 from PIL import Image
 from io import BytesIO
 
@@ -16,9 +24,58 @@ GOOGLE_CX = os.environ.get('GOOGLE_CX')
 if not all([GOOGLE_CUSTOM_API_KEY, GOOGLE_CX]):
     raise ValueError("Please set GOOGLE_CUSTOM_API_KEY and GOOGLE_CX in the .env file")
 
+# Invariant pieces of every Custom Search request, built once; the query
+# suffix is also a stable string so it never perturbs the search cache key
+_WATERMARK_EXCLUSIONS = ' -watermark -"stock photo" -shutterstock -getty -istockphoto -alamy'
+_BASE_PARAMS = {
+    "key": GOOGLE_CUSTOM_API_KEY,
+    "cx": GOOGLE_CX,
+    "searchType": "image",
+    "safe": "off",
+}
+
+# Download concurrency limits (downloads are network-bound, so overlapping
+# them on one event loop gives near-linear speedup up to the remote rate limit)
+MAX_CONCURRENT_DOWNLOADS = 32
+CONNECTOR_LIMIT = 50
+CONNECTOR_LIMIT_PER_HOST = 6
+
+# Number of keywords processed concurrently; a separate axis of parallelism
+# from the per-image download semaphore above
+KEYWORD_CONCURRENCY = 8
+
+# Cap on Custom Search queries per second, to avoid 429s when several
+# keyword tasks hit the API at once
+SEARCH_MAX_QPS = 10
+
+_search_gate = threading.Lock()
+_last_search_time = 0.0
+
+def _wait_search_slot():
+    """Block until the next Custom Search request fits under the QPS cap
+
+    Called only when a request actually goes out, so cache hits never wait.
+    """
+    global _last_search_time
+    with _search_gate:
+        wait = (1.0 / SEARCH_MAX_QPS) - (time.monotonic() - _last_search_time)
+        if wait > 0:
+            time.sleep(wait)
+        _last_search_time = time.monotonic()
+
+# Hard ceiling on a single image download; bodies beyond this are aborted
+# mid-stream so one oversized URL cannot balloon memory or waste bandwidth
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+
+# Downscale saved images so the longest edge is at most this many pixels
+# (0 disables). With xlarge search results the sources are often 10-20 MP;
+# draft() lets libjpeg decode at 1/2-1/8 scale so they never fully decode
+TARGET_MAX_EDGE = int(os.environ.get('MAX_EDGE', '1600'))
+
 def search_images(keyword, num=5, img_size='huge', img_type='photo',
                   img_color_type=None, img_dominant_color=None, file_type=None,
-                  exclude_watermark=True, date_restrict=None, sort_by_date=False):
+                  exclude_watermark=True, date_restrict=None, sort_by_date=False,
+                  session=SESSION):
     """
     Search for images using Google Custom Search API
     Supports fetching more than 10 images through pagination
@@ -29,15 +86,44 @@ def search_images(keyword, num=5, img_size='huge', img_type='photo',
             - Examples: 'd7' (last 7 days), 'm6' (last 6 months), 'y1' (last year)
         sort_by_date: Sort results by date (newest first)
     """
+    # Re-runs for the same keyword and parameters hit the disk cache
+    # instead of spending API latency and quota again
+    cache_key = params_key({
+        'q': keyword, 'num': num, 'imgSize': img_size, 'imgType': img_type,
+        'imgColorType': img_color_type, 'imgDominantColor': img_dominant_color,
+        'fileType': file_type, 'excludeWatermark': exclude_watermark,
+        'dateRestrict': date_restrict, 'sortByDate': sort_by_date,
+    })
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     url = "https://www.googleapis.com/customsearch/v1"
 
     # Add exclusion terms for watermarked images
-    search_query = keyword
-    if exclude_watermark:
-        search_query = f'{keyword} -watermark -"stock photo" -shutterstock -getty -istockphoto -alamy'
+    search_query = keyword + (_WATERMARK_EXCLUSIONS if exclude_watermark else '')
 
     all_images = []
 
+    # Extend the invariant template; only num/start vary per page
+    base_params = _BASE_PARAMS | {
+        "q": search_query,
+        "imgSize": img_size,
+        "imgType": img_type,
+    }
+
+    # Add optional parameters
+    if img_color_type:
+        base_params["imgColorType"] = img_color_type
+    if img_dominant_color:
+        base_params["imgDominantColor"] = img_dominant_color
+    if file_type:
+        base_params["fileType"] = file_type
+    if date_restrict:
+        base_params["dateRestrict"] = date_restrict
+    if sort_by_date:
+        base_params["sort"] = "date"
+
     # Calculate how many requests we need (max 10 per request)
     max_total = min(num, 100)
     requests_needed = (max_total + 9) // 10
@@ -49,32 +135,17 @@ def search_images(keyword, num=5, img_size='huge', img_type='photo',
         if results_needed <= 0:
             break
 
-        params = {
-            "key": GOOGLE_CUSTOM_API_KEY,
-            "cx": GOOGLE_CX,
-            "q": search_query,
-            "searchType": "image",
-            "num": results_needed,
-            "start": start_index,
-            "imgSize": img_size,
-            "imgType": img_type,
-            "safe": "off"
-        }
-
-        # Add optional parameters
-        if img_color_type:
-            params["imgColorType"] = img_color_type
-        if img_dominant_color:
-            params["imgDominantColor"] = img_dominant_color
-        if file_type:
-            params["fileType"] = file_type
-        if date_restrict:
-            params["dateRestrict"] = date_restrict
-        if sort_by_date:
-            params["sort"] = "date"
+        params = base_params | {"num": results_needed, "start": start_index}
 
         try:
-            response = requests.get(url, params=params)
+            _wait_search_slot()
+            response = session.get(url, params=params)
+            if response.status_code == 429:
+                # Only wait when the API actually tells us to back off
+                retry_after = retry_after_seconds(response.headers)
+                print(f"  ⚠ Rate limited, waiting {retry_after:.0f}s...")
+                time.sleep(retry_after)
+                response = session.get(url, params=params)
             response.raise_for_status()
             results = response.json()
 
@@ -92,76 +163,290 @@ def search_images(keyword, num=5, img_size='huge', img_type='photo',
                     'source': item.get('displayLink')
                 })
 
-            # Small delay between requests
-            if request_index < requests_needed - 1 and items:
-                time.sleep(0.3)
+            # A short page or a missing nextPage link means the API has no
+            # further results; don't spend another request finding that out
+            if len(items) < results_needed or 'nextPage' not in results.get('queries', {}):
+                break
 
-        except requests.exceptions.RequestException as e:
+        except REQUEST_EXCEPTIONS as e:
             print(f"  ⚠ Error fetching page {request_index + 1}: {e}")
             break
 
+    if all_images:
+        search_cache.set(cache_key, all_images, expire=SEARCH_CACHE_TTL)
+
     return all_images
 
-def download_image(url, filename, max_retries=3):
-    """Download image with retry logic, validation, and format conversion"""
-    for attempt in range(max_retries):
+# Related keywords often share result URLs; remembering where each URL was
+# saved lets repeats be hardlinked instead of re-downloaded
+URL_CACHE_PATH = os.path.join('.cache', 'url_cache.pkl')
+
+def _load_url_cache():
+    try:
+        with open(URL_CACHE_PATH, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.PickleError):
+        return {}
+
+def _save_url_cache(url_cache):
+    os.makedirs(os.path.dirname(URL_CACHE_PATH), exist_ok=True)
+    tmp_path = URL_CACHE_PATH + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(url_cache, f)
+    os.replace(tmp_path, URL_CACHE_PATH)
+
+def sniff_jpeg_ok(path):
+    """Cheap JPEG validity check: magic marker at the start
+
+    One 3-byte read instead of the full-file parse Image.verify does. Only
+    the SOI magic is checked — the verbatim fast path writes network bytes
+    as-is, and real-world JPEGs legitimately carry trailing padding after
+    the EOI marker, so requiring the file to end with EOI would reject
+    files Pillow itself accepts.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(3)
+    except OSError:
+        return False
+    return head == b'\xff\xd8\xff'
+
+def _process_image_bytes(content, filename):
+    """Validate image bytes with Pillow, convert to RGB if needed, and save as JPEG"""
+    # Fast path: the bytes are already an RGB JPEG. Image.verify walks the
+    # structure without the full decode, so a valid file is written to disk
+    # verbatim — no IDCT + re-encode pass and no second generation loss.
+    # CMYK/grayscale JPEGs fall through to the convert path below.
+    if content[:3] == b'\xff\xd8\xff':
         try:
-            response = requests.get(url, timeout=10)
-            if response.status_code == 200:
-                content = response.content
+            with Image.open(BytesIO(content)) as probe:
+                is_rgb = probe.mode == 'RGB'
+                fits = not TARGET_MAX_EDGE or max(probe.size) <= TARGET_MAX_EDGE
+                probe.verify()
+            if is_rgb and fits:
+                with open(filename, 'wb') as f:
+                    f.write(content)
+                return True
+        except Exception:
+            return False
+
+    try:
+        img = Image.open(BytesIO(content))
+
+        # Ask libjpeg for a DCT-scaled decode (1/2, 1/4, or 1/8) when the
+        # source is far larger than the target; the exact resize follows
+        if TARGET_MAX_EDGE and max(img.size) > TARGET_MAX_EDGE:
+            img.draft('RGB', (TARGET_MAX_EDGE, TARGET_MAX_EDGE))
+
+        # Convert to RGB if necessary
+        if img.mode in ('RGBA', 'LA', 'P'):
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        if TARGET_MAX_EDGE and max(img.size) > TARGET_MAX_EDGE:
+            img.thumbnail((TARGET_MAX_EDGE, TARGET_MAX_EDGE), Image.LANCZOS)
+
+        # Save as JPEG
+        img.save(filename, 'JPEG', quality=90, subsampling=2, optimize=False, progressive=False)
+        return True
+    except Exception:
+        return False
+
+# The Pillow decode/composite/resize/encode stage is CPU-bound and only
+# partially releases the GIL, so it runs in worker processes rather than
+# threads; one pool is shared across the whole run. forkserver keeps worker
+# startup cheap on Linux without fork's copied-state pitfalls.
+_process_pool = None
+
+def _get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        methods = multiprocessing.get_all_start_methods()
+        ctx = multiprocessing.get_context(
+            'forkserver' if 'forkserver' in methods else 'spawn')
+        _process_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=ctx)
+    return _process_pool
+
+async def download_image_async(session, url, filename, sem, max_retries=3):
+    """Download image asynchronously with retry logic, validation, and format conversion"""
+    async with sem:
+        for attempt in range(max_retries):
+            try:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    response.raise_for_status()
+                    # Header-level preflight: reject error pages and
+                    # oversized bodies before reading a single chunk
+                    if headers_preclude_image(response.headers, MAX_DOWNLOAD_BYTES):
+                        return False
+                    # The preflight can't see chunked responses without a
+                    # Content-Length, so enforce the cap mid-stream too
+                    buf = bytearray()
+                    async for chunk in response.content.iter_chunked(65536):
+                        buf += chunk
+                        if len(buf) > MAX_DOWNLOAD_BYTES:
+                            print(f"  Image exceeded {MAX_DOWNLOAD_BYTES // (1024 * 1024)}MB cap, skipped")
+                            return False
+                    content = bytes(buf)
 
                 # Validate image content size
                 if len(content) < 1024:
                     if attempt < max_retries - 1:
                         print(f"  Downloaded file too small ({len(content)} bytes), retrying...")
-                        time.sleep(1)
+                        await asyncio.sleep(2 ** attempt)
                         continue
                     else:
                         print(f"  Downloaded file too small ({len(content)} bytes)")
                         return False
 
-                # Try to open image with Pillow to validate and convert if needed
-                try:
-                    img = Image.open(BytesIO(content))
-
-                    # Convert to RGB if necessary
-                    if img.mode in ('RGBA', 'LA', 'P'):
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        if img.mode == 'P':
-                            img = img.convert('RGBA')
-                        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                        img = background
-                    elif img.mode != 'RGB':
-                        img = img.convert('RGB')
-
-                    # Save as JPEG
-                    img.save(filename, 'JPEG', quality=95)
+                # Offload the Pillow decode/convert/save to a worker process
+                # so the event loop stays free and the encoding scales
+                # across cores
+                loop = asyncio.get_running_loop()
+                if await loop.run_in_executor(_get_process_pool(),
+                                              _process_image_bytes, content, filename):
                     return True
 
-                except Exception as img_error:
-                    if attempt < max_retries - 1:
-                        print(f"  Invalid image format, retrying...")
-                        time.sleep(1)
-                        continue
-                    else:
-                        print(f"  Cannot process image: {img_error}")
-                        return False
+                if attempt < max_retries - 1:
+                    print(f"  Invalid image format, retrying...")
+                    await asyncio.sleep(2 ** attempt)
+                else:
+                    print(f"  Cannot process image from {url}")
+                    return False
+
+            except Exception as e:
+                if attempt < max_retries - 1:
+                    print(f"  Download attempt {attempt + 1} failed, retrying...")
+                    await asyncio.sleep(2 ** attempt)
+                else:
+                    print(f"  Download failed after {max_retries} attempts: {e}")
+        return False
+
+async def process_keyword(session, sem, keyword_sem, item, output_candidates_dir, search_kwargs,
+                          url_cache):
+    """Search a keyword and download all its candidate images concurrently"""
+    async with keyword_sem:
+        await _process_keyword_inner(session, sem, item, output_candidates_dir, search_kwargs,
+                                     url_cache)
+
+async def _process_keyword_inner(session, sem, item, output_candidates_dir, search_kwargs,
+                                 url_cache):
+    keyword = item['keyword_formatted']
+    keyword_id = item['id']
+    num_results = search_kwargs['num']
+
+    # Create folder for candidates
+    keyword_folder = os.path.join(output_candidates_dir, item['_slug'])
+
+    # Check if folder already exists and has images
+    if os.path.exists(keyword_folder):
+        existing_images = [f for f in os.listdir(keyword_folder) if f.endswith('.jpg')]
+        if len(existing_images) >= num_results:
+            print(f"Skipping [{keyword_id}]: {keyword} (already has {len(existing_images)} images)")
+            return
+
+    print(f"Processing keyword [{keyword_id}]: {keyword}")
+    images = await asyncio.to_thread(search_images, keyword, **search_kwargs)
+
+    if not images:
+        print("  No images found")
+        return
+
+    # Only create the candidates folder once the search produced something
+    # to put in it; no-result keywords leave no empty directories behind
+    os.makedirs(keyword_folder, exist_ok=True)
+
+    print(f"  Found {len(images)} images, downloading all...")
+
+    # Download all images to candidates folder concurrently; URLs already
+    # fetched for an earlier keyword are hardlinked instead of re-fetched
+    downloads = []
+    reused = []
+    async with asyncio.TaskGroup() as tg:
+        for img_index, img_data in enumerate(images):
+            url = img_data.get('original', img_data.get('link', ''))
+            candidate_filename = os.path.join(keyword_folder, f"candidate_{img_index + 1}.jpg")
+
+            cached_path = url_cache.get(url)
+            if cached_path and cached_path != candidate_filename and os.path.exists(cached_path):
+                reused.append((img_index, candidate_filename, cached_path))
+                continue
 
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"  Download attempt {attempt + 1} failed, retrying...")
-                time.sleep(1)
-            else:
-                print(f"  Download failed after {max_retries} attempts: {e}")
-    return False
+            task = tg.create_task(download_image_async(session, url, candidate_filename, sem))
+            downloads.append((img_index, url, candidate_filename, task))
+
+    downloaded_count = 0
+    for img_index, candidate_filename, cached_path in reused:
+        if link_or_copy(cached_path, candidate_filename):
+            print(f"    ✓ Candidate {img_index + 1} reused from earlier download")
+            downloaded_count += 1
+        else:
+            print(f"    ✗ Failed to reuse cached file for candidate {img_index + 1}")
+
+    for img_index, url, candidate_filename, task in downloads:
+        if task.result():
+            try:
+                file_size = os.path.getsize(candidate_filename)
+                if file_size < 1024:
+                    print(f"    ⚠ Candidate {img_index + 1} too small, skipped")
+                    os.remove(candidate_filename)
+                    continue
+
+                # Quick validation via marker sniff, no decode
+                if not sniff_jpeg_ok(candidate_filename):
+                    raise ValueError("invalid JPEG markers")
+
+                print(f"    ✓ Candidate {img_index + 1} saved ({file_size // 1024}KB)")
+                downloaded_count += 1
+                url_cache[url] = candidate_filename
+            except Exception as e:
+                print(f"    ⚠ Candidate {img_index + 1} corrupted, skipped")
+                if os.path.exists(candidate_filename):
+                    os.remove(candidate_filename)
+                continue
+        else:
+            print(f"    ✗ Failed to download candidate {img_index + 1}")
+
+    if downloaded_count > 0:
+        print(f"  ✓ Downloaded {downloaded_count}/{len(images)} images to: {keyword_folder}")
+    else:
+        print(f"  ✗ No images downloaded successfully")
+
+async def run_downloads(filtered_keywords, output_candidates_dir, search_kwargs):
+    """Run all keyword downloads over one shared connection pool"""
+    connector = aiohttp.TCPConnector(
+        limit=CONNECTOR_LIMIT,
+        limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+        ttl_dns_cache=300
+    )
+    sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    keyword_sem = asyncio.Semaphore(KEYWORD_CONCURRENCY)
+    url_cache = _load_url_cache()
+
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async with asyncio.TaskGroup() as tg:
+                for item in filtered_keywords:
+                    tg.create_task(process_keyword(session, sem, keyword_sem, item,
+                                                   output_candidates_dir, search_kwargs,
+                                                   url_cache))
+    finally:
+        _save_url_cache(url_cache)
+        if _process_pool is not None:
+            _process_pool.shutdown()
 
 def main():
-    # Load keywords from JSON
-    with open('keywords.json', 'r', encoding='utf-8') as f:
-        keywords_data = json.load(f)
+    # Load keywords from JSON (streamed when ijson is available)
+    keywords_data = load_keywords()
 
-    # Filter out invalid entries
-    keywords_data = [k for k in keywords_data if k['id'] not in ['编号', '']]
+    # Precompute each keyword's filename slug once instead of re-deriving
+    # it at every use in the pipeline
+    for k in keywords_data:
+        k['_slug'] = f"{k['id']}_{k['keyword_formatted'].replace(' ', '_')}"
 
     output_candidates_dir = 'output_candidates'
     os.makedirs(output_candidates_dir, exist_ok=True)
@@ -177,41 +462,7 @@ def main():
     sort_by_date = os.environ.get('SORT_BY_DATE', 'false').lower() == 'true'
 
     # Keyword range configuration
-    process_ids_str = os.environ.get('PROCESS_IDS', None)
-    process_parts_str = os.environ.get('PROCESS_PARTS', None)
-
-    # Filter keywords based on configuration
-    if process_ids_str:
-        selected_ids = set()
-        for id_spec in process_ids_str.split(','):
-            id_spec = id_spec.strip()
-            if ':' in id_spec:
-                start_id, end_id = id_spec.split(':')
-                start_part, start_num = map(int, start_id.split('-'))
-                end_part, end_num = map(int, end_id.split('-'))
-
-                if start_part != end_part:
-                    print(f"Warning: Range {id_spec} spans multiple parts, skipping")
-                    continue
-
-                for num in range(start_num, end_num + 1):
-                    selected_ids.add(f"{start_part}-{num}")
-            else:
-                selected_ids.add(id_spec)
-
-        filtered_keywords = [k for k in keywords_data if k['id'] in selected_ids]
-        range_desc = f"IDs: {process_ids_str}"
-
-    elif process_parts_str:
-        parts = [p.strip() for p in process_parts_str.split(',')]
-        filtered_keywords = [k for k in keywords_data if k['id'].split('-')[0] in parts]
-        range_desc = f"Parts: {process_parts_str}"
-
-    else:
-        start_index = int(os.environ.get('START_INDEX', '0'))
-        end_index = int(os.environ.get('END_INDEX', str(len(keywords_data))))
-        filtered_keywords = keywords_data[start_index:end_index]
-        range_desc = f"Index {start_index} to {end_index}"
+    filtered_keywords, range_desc = filter_keywords(keywords_data)
 
     print(f"Download Configuration:")
     print(f"  - Image Size: {img_size}")
@@ -230,74 +481,19 @@ def main():
     print(f"  - Processing: {range_desc} ({len(filtered_keywords)} keywords)")
     print(f"  - Output: All candidates → 'output_candidates/'\n")
 
-    for item in filtered_keywords:
-        keyword = item['keyword_formatted']
-        keyword_id = item['id']
-
-        # Create folder for candidates
-        keyword_folder = os.path.join(output_candidates_dir, f"{keyword_id}_{keyword.replace(' ', '_')}")
-
-        # Check if folder already exists and has images
-        if os.path.exists(keyword_folder):
-            existing_images = [f for f in os.listdir(keyword_folder) if f.endswith('.jpg')]
-            if len(existing_images) >= num_results:
-                print(f"Skipping [{keyword_id}]: {keyword} (already has {len(existing_images)} images)")
-                continue
-
-        os.makedirs(keyword_folder, exist_ok=True)
-
-        print(f"Processing keyword [{keyword_id}]: {keyword}")
-        images = search_images(
-            keyword,
-            num=num_results,
-            img_size=img_size,
-            img_type=img_type,
-            img_color_type=img_color_type,
-            img_dominant_color=img_dominant_color,
-            file_type=file_type,
-            exclude_watermark=True,
-            date_restrict=date_restrict,
-            sort_by_date=sort_by_date
-        )
-
-        if not images:
-            print("  No images found")
-            continue
-
-        print(f"  Found {len(images)} images, downloading all...")
-
-        # Download all images to candidates folder
-        downloaded_count = 0
-        for img_index, img_data in enumerate(images):
-            url = img_data.get('original', img_data.get('link', ''))
-            candidate_filename = os.path.join(keyword_folder, f"candidate_{img_index + 1}.jpg")
-
-            if download_image(url, candidate_filename):
-                try:
-                    file_size = os.path.getsize(candidate_filename)
-                    if file_size < 1024:
-                        print(f"    ⚠ Candidate {img_index + 1} too small, skipped")
-                        os.remove(candidate_filename)
-                        continue
-
-                    # Quick validation
-                    with Image.open(candidate_filename) as img:
-                        img.verify()
-
-                    print(f"    ✓ Candidate {img_index + 1} saved ({file_size // 1024}KB)")
-                    downloaded_count += 1
-                except Exception as e:
-                    print(f"    ⚠ Candidate {img_index + 1} corrupted, skipped")
-                    if os.path.exists(candidate_filename):
-                        os.remove(candidate_filename)
-                    continue
-            else:
-                print(f"    ✗ Failed to download candidate {img_index + 1}")
-
-        if downloaded_count > 0:
-            print(f"  ✓ Downloaded {downloaded_count}/{len(images)} images to: {keyword_folder}")
-        else:
-            print(f"  ✗ No images downloaded successfully")
+    search_kwargs = dict(
+        num=num_results,
+        img_size=img_size,
+        img_type=img_type,
+        img_color_type=img_color_type,
+        img_dominant_color=img_dominant_color,
+        file_type=file_type,
+        exclude_watermark=True,
+        date_restrict=date_restrict,
+        sort_by_date=sort_by_date
+    )
+
+    asyncio.run(run_downloads(filtered_keywords, output_candidates_dir, search_kwargs))
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,17 @@
 import json
 import os
+import random
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
 from dotenv import load_dotenv
+from caches import verdict_cache, params_key, file_fingerprint
+from file_utils import link_or_copy
+from keyword_filters import filter_keywords, load_keywords
+from rate_limit import TokenBucket
 from PIL import Image
-import shutil
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,13 +26,78 @@ if not GOOGLE_AI_API_KEY:
 genai.configure(api_key=GOOGLE_AI_API_KEY)
 model = genai.GenerativeModel('gemini-2.5-flash')
 
-def evaluate_best_image(images_folder, keyword, keyword_id, max_retries=3):
-    """Evaluate images using Gemini with retry logic"""
-    # Find all candidate images
+# Transient server-side failures worth retrying; anything else (auth,
+# invalid argument, safety blocks) fails fast instead of burning the
+# retry budget
+RETRYABLE_API_ERRORS = (api_exceptions.InternalServerError,
+                        api_exceptions.ServiceUnavailable,
+                        api_exceptions.ResourceExhausted,
+                        api_exceptions.DeadlineExceeded)
+
+# Constrain single-keyword replies to a JSON object with one integer field,
+# so parsing the verdict is deterministic instead of scraping prose
+_VERDICT_CONFIG = {
+    'response_mime_type': 'application/json',
+    'response_schema': {
+        'type': 'object',
+        'properties': {'best_index': {'type': 'integer'}},
+        'required': ['best_index'],
+    },
+}
+
+# Candidates whose combined size stays under this are sent inline with the
+# prompt, skipping the per-file upload round-trips of the File API
+INLINE_TOTAL_BYTES = 20 * 1024 * 1024
+
+# Upper bound on images per batched evaluation call; keeps the multi-keyword
+# prompt comfortably inside the model's context
+MAX_BATCH_IMAGES = 20
+
+# Pace Gemini calls with a token bucket instead of fixed sleeps: healthy
+# runs never wait, and only sustained traffic above the per-minute quota
+# is slowed down
+GEMINI_BUCKET = TokenBucket(
+    rate_per_min=int(os.environ.get('GEMINI_RATE_PER_MIN', '15')),
+    burst=5,
+)
+
+def _safe_upload(file_path):
+    """Upload one file to Gemini, returning None on failure"""
+    try:
+        GEMINI_BUCKET.acquire()
+        return genai.upload_file(file_path)
+    except Exception as e:
+        print(f"  ⚠ Failed to upload {os.path.basename(file_path)}: {e}")
+        return None
+
+def _safe_delete(uploaded_file):
+    """Delete one uploaded Gemini file, swallowing failures"""
+    try:
+        GEMINI_BUCKET.acquire()
+        uploaded_file.delete()
+    except Exception as e:
+        print(f"  Warning: Failed to delete uploaded file: {e}")
+
+def _candidate_paths(images_folder):
+    """List a keyword folder's candidate files and their full paths"""
     candidate_files = sorted([
         f for f in os.listdir(images_folder)
         if f.startswith('candidate_') and f.endswith('.jpg')
     ])
+    return candidate_files, [os.path.join(images_folder, f) for f in candidate_files]
+
+def _verdict_key(keyword_id, keyword, paths):
+    """Cache key tying a verdict to the keyword and its candidate contents"""
+    return params_key({
+        'keyword_id': keyword_id,
+        'keyword': keyword,
+        'candidates': sorted(file_fingerprint(p) for p in paths),
+    })
+
+def evaluate_best_image(images_folder, keyword, keyword_id, max_retries=3):
+    """Evaluate images using Gemini with retry logic"""
+    # Find all candidate images
+    candidate_files, paths = _candidate_paths(images_folder)
 
     if not candidate_files:
         print(f"  ✗ No candidate images found in {images_folder}")
@@ -33,79 +105,85 @@ def evaluate_best_image(images_folder, keyword, keyword_id, max_retries=3):
 
     print(f"  Found {len(candidate_files)} candidate images")
 
+    # Re-runs with the same candidates reuse the previous verdict instead
+    # of re-uploading and re-evaluating
+    verdict_key = _verdict_key(keyword_id, keyword, paths)
+    cached_index = verdict_cache.get(verdict_key)
+    if cached_index is not None and 1 <= cached_index <= len(candidate_files):
+        print(f"  Using cached verdict: candidate {cached_index}")
+        return os.path.join(images_folder, candidate_files[cached_index - 1])
+
     # Prepare prompt
-    prompt = f"Here are {len(candidate_files)} images searched for the keyword '{keyword}'. Which one is the best match? Choose the index (1 to {len(candidate_files)}) of the best image fitting the keyword without watermark. Just return the number."
+    prompt = f"Here are {len(candidate_files)} images searched for the keyword '{keyword}'. Which one is the best match? Choose the index (1 to {len(candidate_files)}) of the best image fitting the keyword without watermark."
 
-    # Upload images to Gemini
-    uploaded_files = []
-    for candidate_file in candidate_files:
-        file_path = os.path.join(images_folder, candidate_file)
-        try:
-            uploaded_file = genai.upload_file(file_path)
-            uploaded_files.append(uploaded_file)
-            time.sleep(0.5)
-        except Exception as e:
-            print(f"  ⚠ Failed to upload {candidate_file}: {e}")
-            uploaded_files.append(None)
+    # Small candidate sets are passed inline with the prompt, which removes
+    # the upload (and later delete) round-trip per file entirely; only
+    # oversize sets fall back to the File API upload path
+    candidate_bytes = []
+    for p in paths:
+        with open(p, 'rb') as f:
+            candidate_bytes.append(f.read())
 
-    # Add delay before generation
-    time.sleep(2)
+    uploaded_files = []
+    if sum(len(b) for b in candidate_bytes) < INLINE_TOTAL_BYTES:
+        image_parts = [{'mime_type': 'image/jpeg', 'data': b} for b in candidate_bytes]
+    else:
+        # Upload images to Gemini in parallel; the uploads are independent
+        # network calls, so fan-out turns N round-trips into roughly one
+        with ThreadPoolExecutor(max_workers=len(paths)) as ex:
+            uploaded_files = list(ex.map(_safe_upload, paths))
+        image_parts = [uf for uf in uploaded_files if uf]
 
     # Generate content with retry logic
     best_index = 1  # Default to first image
+    evaluation_ok = False
     for attempt in range(max_retries):
         try:
             if attempt > 0:
-                wait_time = 2 ** attempt
-                print(f"  Retrying Gemini evaluation (attempt {attempt + 1}/{max_retries}) in {wait_time}s...")
+                # Full-jitter backoff: desynchronizes retries that hit the
+                # same transient error together
+                wait_time = random.uniform(0, 2 ** attempt)
+                print(f"  Retrying Gemini evaluation (attempt {attempt + 1}/{max_retries}) in {wait_time:.1f}s...")
                 time.sleep(wait_time)
 
-            contents = [prompt]
-            for uf in uploaded_files:
-                if uf:
-                    contents.append(uf)
-
-            response = model.generate_content(contents)
-
-            # Parse response
-            text = response.text.strip()
-            print(f"  Gemini response: {text}")
+            GEMINI_BUCKET.acquire()
+            response = model.generate_content([prompt, *image_parts],
+                                              generation_config=_VERDICT_CONFIG)
 
+            # The schema guarantees a {"best_index": int} reply
             try:
-                best_index = int(text.split()[0])
-                if 1 <= best_index <= len(candidate_files):
-                    break
-                else:
-                    print(f"  ⚠ Invalid index {best_index}, using first image")
-                    best_index = 1
-                    break
-            except:
+                parsed = json.loads(response.text).get('best_index')
+            except json.JSONDecodeError:
+                parsed = None
+            if isinstance(parsed, int) and 1 <= parsed <= len(candidate_files):
+                best_index = parsed
+                evaluation_ok = True
+            else:
                 print(f"  ⚠ Could not parse response, using first image")
                 best_index = 1
-                break
+            break
 
-        except Exception as e:
-            if "500" in str(e) or "Internal" in str(e):
-                if attempt < max_retries - 1:
-                    print(f"  Gemini API error (500), will retry...")
-                else:
-                    print(f"  Gemini evaluation failed after {max_retries} attempts: {e}")
-                    best_index = 1
+        except RETRYABLE_API_ERRORS as e:
+            if attempt < max_retries - 1:
+                print(f"  Transient Gemini error ({type(e).__name__}), will retry...")
             else:
-                print(f"  Error during Gemini evaluation: {e}")
+                print(f"  Gemini evaluation failed after {max_retries} attempts: {e}")
                 best_index = 1
-                break
+        except Exception as e:
+            print(f"  Error during Gemini evaluation: {e}")
+            best_index = 1
+            break
 
-    # Clean up uploaded files from Gemini
-    for uf in uploaded_files:
-        if uf:
-            try:
-                uf.delete()
-            except Exception as e:
-                print(f"  Warning: Failed to delete uploaded file: {e}")
+    # Clean up uploaded files from Gemini; deletes are independent network
+    # round-trips, so run them concurrently
+    to_delete = [uf for uf in uploaded_files if uf]
+    if to_delete:
+        with ThreadPoolExecutor(max_workers=8) as ex:
+            list(ex.map(_safe_delete, to_delete))
 
-    # Add delay after evaluation
-    time.sleep(3)
+    # Only cache verdicts the model actually produced, not fallbacks
+    if evaluation_ok:
+        verdict_cache.set(verdict_key, best_index)
 
     # Return the filename of the best image
     if 1 <= best_index <= len(candidate_files):
@@ -114,98 +192,204 @@ def evaluate_best_image(images_folder, keyword, keyword_id, max_retries=3):
     else:
         return None
 
-def main():
-    # Load keywords from JSON
-    with open('keywords.json', 'r', encoding='utf-8') as f:
-        keywords_data = json.load(f)
+def _parse_json_verdicts(text):
+    """Parse a JSON object out of a model reply, tolerating code fences
+    and surrounding prose"""
+    text = text.strip()
+    if text.startswith('```'):
+        text = text.split('\n', 1)[1].rsplit('```', 1)[0]
+    m = re.search(r'\{.*\}', text, re.S)
+    if m:
+        text = m.group(0)
+    return json.loads(text)
+
+def evaluate_best_images_batch(entries, max_retries=3):
+    """Evaluate several keywords' candidates with a single Gemini call
+
+    entries is a list of (keyword_id, keyword, images_folder) tuples whose
+    combined candidate count should stay within MAX_BATCH_IMAGES. One call
+    replaces len(entries) separate generations; the shared instruction
+    prefix also makes implicit prompt caching more likely to hit. Returns
+    {keyword_id: best_image_path or None}. Entries the model skipped, or
+    the whole batch if its reply cannot be parsed, fall back to the
+    single-keyword path.
+    """
+    results = {}
+    pending = []
+
+    # Resolve cached verdicts first; only the rest go to the model
+    for keyword_id, keyword, images_folder in entries:
+        candidate_files, paths = _candidate_paths(images_folder)
+        if not candidate_files:
+            print(f"  ✗ No candidate images found in {images_folder}")
+            results[keyword_id] = None
+            continue
 
-    # Filter out invalid entries
-    keywords_data = [k for k in keywords_data if k['id'] not in ['编号', '']]
+        verdict_key = _verdict_key(keyword_id, keyword, paths)
+        cached_index = verdict_cache.get(verdict_key)
+        if cached_index is not None and 1 <= cached_index <= len(candidate_files):
+            print(f"  [{keyword_id}] Using cached verdict: candidate {cached_index}")
+            results[keyword_id] = os.path.join(images_folder, candidate_files[cached_index - 1])
+            continue
 
-    output_dir = 'output'
-    output_candidates_dir = 'output_candidates'
-    os.makedirs(output_dir, exist_ok=True)
+        pending.append((keyword_id, keyword, images_folder, candidate_files, paths,
+                        verdict_key))
+
+    if not pending:
+        return results
+
+    # Build one prompt: the invariant instructions lead, followed by one
+    # labelled section of inline images per keyword
+    contents = [
+        'For each keyword section below, choose the image that best fits the '
+        'keyword without a watermark. Images in each section are numbered '
+        'from 1 in the order they appear. Reply with only a JSON object '
+        'mapping each keyword id to the chosen image number, for example '
+        '{"1-1": 2, "1-2": 1}.'
+    ]
+    total_bytes = 0
+    for keyword_id, keyword, images_folder, candidate_files, paths, _ in pending:
+        contents.append(f"[KW {keyword_id}] {keyword} "
+                        f"({len(candidate_files)} images)")
+        for p in paths:
+            with open(p, 'rb') as f:
+                b = f.read()
+            total_bytes += len(b)
+            contents.append({'mime_type': 'image/jpeg', 'data': b})
+
+    # Oversize batches would need the File API; the per-keyword path already
+    # handles uploads, so just defer to it
+    if total_bytes >= INLINE_TOTAL_BYTES:
+        print(f"  Batch too large for inline parts, evaluating per keyword...")
+        for keyword_id, keyword, images_folder, _, _, _ in pending:
+            results[keyword_id] = evaluate_best_image(images_folder, keyword, keyword_id,
+                                                      max_retries=max_retries)
+        return results
+
+    verdicts = None
+    for attempt in range(max_retries):
+        try:
+            if attempt > 0:
+                wait_time = random.uniform(0, 2 ** attempt)
+                print(f"  Retrying batch evaluation (attempt {attempt + 1}/{max_retries}) in {wait_time:.1f}s...")
+                time.sleep(wait_time)
 
-    # Keyword range configuration
-    process_ids_str = os.environ.get('PROCESS_IDS', None)
-    process_parts_str = os.environ.get('PROCESS_PARTS', None)
-
-    # Filter keywords based on configuration
-    if process_ids_str:
-        selected_ids = set()
-        for id_spec in process_ids_str.split(','):
-            id_spec = id_spec.strip()
-            if ':' in id_spec:
-                start_id, end_id = id_spec.split(':')
-                start_part, start_num = map(int, start_id.split('-'))
-                end_part, end_num = map(int, end_id.split('-'))
-
-                if start_part != end_part:
-                    print(f"Warning: Range {id_spec} spans multiple parts, skipping")
-                    continue
-
-                for num in range(start_num, end_num + 1):
-                    selected_ids.add(f"{start_part}-{num}")
+            GEMINI_BUCKET.acquire()
+            response = model.generate_content(contents)
+            text = response.text.strip()
+            print(f"  Gemini batch response: {text}")
+
+            try:
+                verdicts = _parse_json_verdicts(text)
+                break
+            except (json.JSONDecodeError, IndexError):
+                print(f"  ⚠ Could not parse batch response")
+                break
+
+        except RETRYABLE_API_ERRORS as e:
+            if attempt < max_retries - 1:
+                print(f"  Transient Gemini error ({type(e).__name__}), will retry...")
             else:
-                selected_ids.add(id_spec)
+                print(f"  Batch evaluation failed after {max_retries} attempts: {e}")
+        except Exception as e:
+            print(f"  Error during batch evaluation: {e}")
+            break
 
-        filtered_keywords = [k for k in keywords_data if k['id'] in selected_ids]
-        range_desc = f"IDs: {process_ids_str}"
+    for keyword_id, keyword, images_folder, candidate_files, paths, verdict_key in pending:
+        best_index = None
+        if verdicts is not None:
+            try:
+                best_index = int(verdicts.get(str(keyword_id)))
+            except (TypeError, ValueError):
+                best_index = None
+
+        if best_index is not None and 1 <= best_index <= len(candidate_files):
+            verdict_cache.set(verdict_key, best_index)
+            results[keyword_id] = os.path.join(images_folder, candidate_files[best_index - 1])
+        else:
+            # Model skipped this keyword (or the whole reply was unusable):
+            # fall back to the single-keyword evaluation
+            print(f"  [{keyword_id}] No usable batch verdict, evaluating individually...")
+            results[keyword_id] = evaluate_best_image(images_folder, keyword, keyword_id,
+                                                      max_retries=max_retries)
 
-    elif process_parts_str:
-        parts = [p.strip() for p in process_parts_str.split(',')]
-        filtered_keywords = [k for k in keywords_data if k['id'].split('-')[0] in parts]
-        range_desc = f"Parts: {process_parts_str}"
+    return results
 
-    else:
-        start_index = int(os.environ.get('START_INDEX', '0'))
-        end_index = int(os.environ.get('END_INDEX', str(len(keywords_data))))
-        filtered_keywords = keywords_data[start_index:end_index]
-        range_desc = f"Index {start_index} to {end_index}"
+def main():
+    # Load keywords from JSON (streamed when ijson is available)
+    keywords_data = load_keywords()
+
+    output_dir = 'output'
+    output_candidates_dir = 'output_candidates'
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Keyword range configuration
+    filtered_keywords, range_desc = filter_keywords(keywords_data)
 
     print(f"Evaluation Configuration:")
     print(f"  - Processing: {range_desc} ({len(filtered_keywords)} keywords)")
     print(f"  - Input: Candidates from 'output_candidates/'")
     print(f"  - Output: Best image → 'output/'\n")
 
-    evaluated_count = 0
+    # One directory listing each instead of two stat calls per keyword
+    existing_outputs = {e.name for e in os.scandir(output_dir)}
+    candidate_folders = ({e.name for e in os.scandir(output_candidates_dir)}
+                         if os.path.isdir(output_candidates_dir) else set())
+
+    # Collect the keywords that still need a verdict
+    to_evaluate = []
     for item in filtered_keywords:
         keyword = item['keyword_formatted']
         keyword_id = item['id']
+        slug = f"{keyword_id}_{keyword.replace(' ', '_')}"
 
         # Check if output image already exists
-        final_filename = os.path.join(output_dir, f"{keyword_id}_{keyword.replace(' ', '_')}.jpg")
-        if os.path.exists(final_filename):
+        if f"{slug}.jpg" in existing_outputs:
             print(f"Skipping [{keyword_id}]: {keyword} (already exists in output)")
             continue
 
         # Find candidates folder
-        keyword_folder = os.path.join(output_candidates_dir, f"{keyword_id}_{keyword.replace(' ', '_')}")
-
-        if not os.path.exists(keyword_folder):
+        if slug not in candidate_folders:
             print(f"Skipping [{keyword_id}]: {keyword} (no candidates folder found)")
             continue
 
-        print(f"Evaluating keyword [{keyword_id}]: {keyword}")
-
-        # Use Gemini to evaluate
-        best_image_path = evaluate_best_image(keyword_folder, keyword, keyword_id)
-
-        if best_image_path and os.path.exists(best_image_path):
-            try:
-                shutil.copy2(best_image_path, final_filename)
-                print(f"  ✓ Best image copied to output: {final_filename}")
-                evaluated_count += 1
-            except Exception as e:
-                print(f"  ✗ Failed to copy best image: {e}")
-        else:
-            print(f"  ✗ No valid best image found")
+        to_evaluate.append((keyword_id, keyword,
+                            os.path.join(output_candidates_dir, slug),
+                            os.path.join(output_dir, f"{slug}.jpg")))
+
+    # Group keywords so each Gemini call evaluates several of them at once,
+    # up to MAX_BATCH_IMAGES candidate images per call
+    batches = []
+    batch, batch_images = [], 0
+    for entry in to_evaluate:
+        candidate_count = len(_candidate_paths(entry[2])[0])
+        if batch and batch_images + candidate_count > MAX_BATCH_IMAGES:
+            batches.append(batch)
+            batch, batch_images = [], 0
+        batch.append(entry)
+        batch_images += candidate_count
+    if batch:
+        batches.append(batch)
 
-        # Cooldown every 10 evaluations
-        if evaluated_count > 0 and evaluated_count % 10 == 0:
-            print(f"\n⏸️  Cooldown period: waiting 30 seconds to avoid rate limits...")
-            time.sleep(30)
-            print("✓ Resuming evaluation\n")
+    evaluated_count = 0
+    for batch in batches:
+        ids = ', '.join(str(entry[0]) for entry in batch)
+        print(f"Evaluating batch [{ids}]")
+
+        verdicts = evaluate_best_images_batch(
+            [(keyword_id, keyword, keyword_folder)
+             for keyword_id, keyword, keyword_folder, _ in batch])
+
+        for keyword_id, keyword, keyword_folder, final_filename in batch:
+            best_image_path = verdicts.get(keyword_id)
+            if best_image_path and os.path.exists(best_image_path):
+                if link_or_copy(best_image_path, final_filename):
+                    print(f"  ✓ [{keyword_id}] Best image copied to output: {final_filename}")
+                    evaluated_count += 1
+                else:
+                    print(f"  ✗ [{keyword_id}] Failed to copy best image")
+            else:
+                print(f"  ✗ [{keyword_id}] No valid best image found")
 
     print(f"\n✓ Evaluation complete! Evaluated {evaluated_count} keywords.")
 
@@ -0,0 +1,23 @@
+"""Filesystem helpers shared by the pipeline scripts."""
+import os
+import shutil
+
+def link_or_copy(src, dst):
+    """Hardlink src to dst (zero data copy), falling back to a real copy
+
+    output/ and output_candidates/ normally share a filesystem, so the
+    common case is a pure inode operation with no image bytes read or
+    written; cross-device setups silently degrade to copy2. An existing
+    dst is replaced. Returns True on success.
+    """
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+        return True
+    except OSError:
+        try:
+            shutil.copy2(src, dst)
+            return True
+        except OSError:
+            return False
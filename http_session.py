@@ -0,0 +1,94 @@
+"""Shared HTTP client with connection pooling and retries.
+
+Reusing one client keeps TCP/TLS connections alive between requests, so
+repeated calls to the Google Custom Search endpoint and to image CDNs skip
+the full handshake (~1 RTT + crypto) that a bare requests.get pays every
+time.
+
+When httpx is installed (pip install httpx[http2]), the client negotiates
+HTTP/2 with hosts that support it, multiplexing many image downloads over a
+single TLS connection. Otherwise a pooled requests.Session is used.
+
+This client backs the Custom Search calls. The candidate downloaders use
+aiohttp: aiohttp speaks HTTP/1.1 only, but connection pooling plus
+event-loop concurrency already overlap those fetches, and the hosts
+involved are many distinct image CDNs where per-host multiplexing buys
+little.
+"""
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+_USER_AGENT = "Mozilla/5.0 (compatible; SmartImageSearchTool/1.0)"
+
+if httpx is not None:
+    SESSION = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        headers={"User-Agent": _USER_AGENT},
+        timeout=10,
+        follow_redirects=True,
+    )
+    REQUEST_EXCEPTIONS = (requests.exceptions.RequestException, httpx.HTTPError)
+else:
+    # Retry transient server errors and rate limits at the transport layer,
+    # honouring Retry-After so the session sleeps only as long as the server
+    # asks rather than a fixed worst-case pause
+    _retry = Retry(total=3, backoff_factor=0.5,
+                   status_forcelist=[429, 500, 502, 503, 504],
+                   respect_retry_after_header=True)
+    _adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=_retry)
+
+    SESSION = requests.Session()
+    SESSION.headers.update({"User-Agent": _USER_AGENT})
+    SESSION.mount('https://', _adapter)
+    SESSION.mount('http://', _adapter)
+
+    REQUEST_EXCEPTIONS = (requests.exceptions.RequestException,)
+
+def retry_after_seconds(headers, default=1):
+    """Parse a Retry-After header into seconds to wait
+
+    The header may carry either a delay in seconds or an HTTP-date
+    (RFC 7231 allows both); unparseable values fall back to the default
+    rather than raising mid-download.
+    """
+    value = headers.get('Retry-After')
+    if value is None:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0, (when - datetime.now(timezone.utc)).total_seconds())
+
+def headers_preclude_image(headers, max_bytes):
+    """Decide from response headers alone whether a body can't be a usable image
+
+    Hotlink-protected or dead URLs usually answer with a tiny HTML error
+    page; rejecting on the headers of the streamed GET costs nothing and
+    skips reading the body. Only clearly-wrong headers reject — many CDNs
+    omit or mislabel Content-Type on real images.
+    """
+    ctype = headers.get('Content-Type', '')
+    if ctype.startswith('text/') or ctype.startswith('application/json'):
+        return True
+    length = int(headers.get('Content-Length', '0'))
+    if 0 < length < 1024:
+        return True
+    if length > max_bytes:
+        print(f"  Image too large (Content-Length over {max_bytes // (1024 * 1024)}MB), skipped")
+        return True
+    return False
@@ -1,15 +1,44 @@
+import asyncio
+import atexit
+import csv
 import json
+import logging
 import os
-import requests
+import queue
+import random
+import signal
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+import aiohttp
 import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
 from dotenv import load_dotenv
+from caches import search_cache, verdict_cache, params_key, SEARCH_CACHE_TTL
+from file_utils import link_or_copy
+from http_session import SESSION, REQUEST_EXCEPTIONS, headers_preclude_image, retry_after_seconds
+from keyword_filters import filter_keywords, load_keywords
+from rate_limit import TokenBucket
 from PIL import Image
 from io import BytesIO
 
-# Load environment variables from .env file
+# Load environment variables from .env file (before any config is read)
 load_dotenv()
 
+# Route log records through a queue so the many concurrent download tasks
+# never block on stdout; a single background listener does the actual I/O.
+# Per-image chatter sits at DEBUG, so the default INFO level emits roughly
+# one line per keyword (set LOGLEVEL=DEBUG to get the old verbosity)
+_log_queue = queue.SimpleQueue()
+logging.basicConfig(level=os.environ.get('LOGLEVEL', 'INFO'),
+                    handlers=[QueueHandler(_log_queue)])
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+log = logging.getLogger(__name__)
+
 # Set up API keys
 GOOGLE_CUSTOM_API_KEY = os.environ.get('GOOGLE_CUSTOM_API_KEY')  # For Google Custom Search
 GOOGLE_CX = os.environ.get('GOOGLE_CX')  # Custom Search Engine ID
@@ -22,8 +51,105 @@ if not all([GOOGLE_CUSTOM_API_KEY, GOOGLE_CX, GOOGLE_AI_API_KEY]):
 genai.configure(api_key=GOOGLE_AI_API_KEY)
 model = genai.GenerativeModel('gemini-2.5-flash')  # Use latest vision model
 
+# Transient server-side failures worth retrying; anything else (auth,
+# invalid argument, safety blocks) fails fast instead of burning the
+# retry budget
+RETRYABLE_API_ERRORS = (api_exceptions.InternalServerError,
+                        api_exceptions.ServiceUnavailable,
+                        api_exceptions.ResourceExhausted,
+                        api_exceptions.DeadlineExceeded)
+
+# Per-keyword outcomes are buffered and appended to the CSV in batches, so
+# progress tracking costs one write per _FLUSH_EVERY keywords instead of one
+# per keyword; atexit and the SIGINT hook below make sure nothing is lost
+RESULTS_CSV = os.path.join('output', 'results.csv')
+_RESULTS_FIELDS = ['id', 'keyword', 'url', 'filename', 'status']
+_FLUSH_EVERY = 10
+_results_buffer = []
+_results_lock = threading.Lock()
+
+# Completed keyword ids, checkpointed alongside the CSV so resumes skip by
+# id rather than stat-ing an output filename per keyword — which also
+# survives IMG_SIZE or slug changes that rename the outputs
+PROCESSED_PATH = os.path.join('output', '.processed.json')
+_processed_ids = set()
+
+def load_processed(output_dir):
+    """Load the checkpoint set, folding in files already in output_dir
+
+    The directory is folded in with a single scandir pass instead of one
+    exists() per keyword; output names are '{id}_{slug}.jpg'.
+    """
+    try:
+        with open(PROCESSED_PATH, 'r', encoding='utf-8') as f:
+            _processed_ids.update(json.load(f))
+    except (OSError, json.JSONDecodeError):
+        pass
+    for entry in os.scandir(output_dir):
+        if entry.is_file() and entry.name.endswith('.jpg'):
+            _processed_ids.add(entry.name.split('_', 1)[0])
+    return _processed_ids
+
+def _flush_results_locked():
+    if not _results_buffer:
+        return
+    os.makedirs(os.path.dirname(RESULTS_CSV), exist_ok=True)
+    write_header = not os.path.exists(RESULTS_CSV)
+    with open(RESULTS_CSV, 'a', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=_RESULTS_FIELDS)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(_results_buffer)
+    _results_buffer.clear()
+
+    # Checkpoint the processed-ids set in the same batch
+    tmp_path = PROCESSED_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(sorted(_processed_ids), f)
+    os.replace(tmp_path, PROCESSED_PATH)
+
+def flush_results():
+    with _results_lock:
+        _flush_results_locked()
+
+def record_result(keyword_id, keyword, url, filename, status):
+    """Buffer one result row, flushing every _FLUSH_EVERY entries"""
+    with _results_lock:
+        _results_buffer.append({'id': keyword_id, 'keyword': keyword, 'url': url,
+                                'filename': filename, 'status': status})
+        if status == 'ok':
+            _processed_ids.add(keyword_id)
+        if len(_results_buffer) >= _FLUSH_EVERY:
+            _flush_results_locked()
+
+def _sigint_flush(signum, frame):
+    flush_results()
+    raise KeyboardInterrupt
+
+atexit.register(flush_results)
+signal.signal(signal.SIGINT, _sigint_flush)
+
+# Invariant pieces of every Custom Search request, built once; the query
+# suffix is also a stable string so it never perturbs the search cache key
+_WATERMARK_EXCLUSIONS = ' -watermark -"stock photo" -shutterstock -getty -istockphoto -alamy'
+_BASE_PARAMS = {
+    "key": GOOGLE_CUSTOM_API_KEY,
+    "cx": GOOGLE_CX,
+    "searchType": "image",
+    "safe": "off",
+}
+
+# Pace all Gemini traffic (uploads, generations, deletes) through one token
+# bucket; calls only wait when the per-minute allowance is actually spent,
+# unlike the fixed sleeps this replaces
+GEMINI_BUCKET = TokenBucket(
+    rate_per_min=int(os.environ.get('GEMINI_RATE_PER_MIN', '15')),
+    burst=5,
+)
+
 def search_images(keyword, num=5, img_size='huge', img_type='photo',
-                  img_color_type=None, img_dominant_color=None, file_type=None, exclude_watermark=True):
+                  img_color_type=None, img_dominant_color=None, file_type=None, exclude_watermark=True,
+                  session=SESSION):
     """
     Search for images using Google Custom Search API
     Supports fetching more than 10 images through pagination
@@ -57,15 +183,39 @@ def search_images(keyword, num=5, img_size='huge', img_type='photo',
             - 'jpg', 'gif', 'png', 'bmp', 'svg', 'webp', 'ico'
         exclude_watermark: Exclude images with watermarks (default: True)
     """
+    # Re-runs for the same keyword and parameters hit the disk cache
+    # instead of spending API latency and quota again
+    cache_key = params_key({
+        'q': keyword, 'num': num, 'imgSize': img_size, 'imgType': img_type,
+        'imgColorType': img_color_type, 'imgDominantColor': img_dominant_color,
+        'fileType': file_type, 'excludeWatermark': exclude_watermark,
+    })
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     url = "https://www.googleapis.com/customsearch/v1"
 
     # Add exclusion terms for watermarked images
-    search_query = keyword
-    if exclude_watermark:
-        search_query = f'{keyword} -watermark -"stock photo" -shutterstock -getty -istockphoto -alamy'
+    search_query = keyword + (_WATERMARK_EXCLUSIONS if exclude_watermark else '')
 
     all_images = []
 
+    # Extend the invariant template; only num/start vary per page
+    base_params = _BASE_PARAMS | {
+        "q": search_query,
+        "imgSize": img_size,
+        "imgType": img_type,
+    }
+
+    # Add optional parameters
+    if img_color_type:
+        base_params["imgColorType"] = img_color_type
+    if img_dominant_color:
+        base_params["imgDominantColor"] = img_dominant_color
+    if file_type:
+        base_params["fileType"] = file_type
+
     # Calculate how many requests we need (max 10 per request)
     # Google allows up to 100 results total with pagination
     max_total = min(num, 100)
@@ -78,28 +228,16 @@ def search_images(keyword, num=5, img_size='huge', img_type='photo',
         if results_needed <= 0:
             break
 
-        params = {
-            "key": GOOGLE_CUSTOM_API_KEY,
-            "cx": GOOGLE_CX,
-            "q": search_query,
-            "searchType": "image",
-            "num": results_needed,
-            "start": start_index,  # Pagination parameter
-            "imgSize": img_size,
-            "imgType": img_type,
-            "safe": "off"
-        }
-
-        # Add optional parameters
-        if img_color_type:
-            params["imgColorType"] = img_color_type
-        if img_dominant_color:
-            params["imgDominantColor"] = img_dominant_color
-        if file_type:
-            params["fileType"] = file_type
+        params = base_params | {"num": results_needed, "start": start_index}
 
         try:
-            response = requests.get(url, params=params)
+            response = session.get(url, params=params)
+            if response.status_code == 429:
+                # Only wait when the API actually tells us to back off
+                retry_after = retry_after_seconds(response.headers)
+                log.warning(f"  ⚠ Rate limited, waiting {retry_after:.0f}s...")
+                time.sleep(retry_after)
+                response = session.get(url, params=params)
             response.raise_for_status()
             results = response.json()
 
@@ -119,170 +257,323 @@ def search_images(keyword, num=5, img_size='huge', img_type='photo',
                     'source': item.get('displayLink')
                 })
 
-            # Small delay between requests to be respectful
-            if request_index < requests_needed - 1 and items:
-                time.sleep(0.3)
+            # A short page or a missing nextPage link means the API has no
+            # further results; don't spend another request finding that out
+            if len(items) < results_needed or 'nextPage' not in results.get('queries', {}):
+                break
 
-        except requests.exceptions.RequestException as e:
-            print(f"  ⚠ Error fetching page {request_index + 1}: {e}")
+        except REQUEST_EXCEPTIONS as e:
+            log.warning(f"  ⚠ Error fetching page {request_index + 1}: {e}")
             # Continue with what we have
             break
 
+    if all_images:
+        search_cache.set(cache_key, all_images, expire=SEARCH_CACHE_TTL)
+
     return all_images
 
-def download_image(url, filename, max_retries=3):
-    """Download image with retry logic, validation, and format conversion"""
-    for attempt in range(max_retries):
+def _sniff_format(buf):
+    """Identify common image formats from the first few bytes"""
+    if buf[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if buf[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if buf[:4] == b'RIFF' and buf[8:12] == b'WEBP':
+        return 'webp'
+    if buf[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    return None
+
+# Hard ceiling on a single image download; bodies beyond this are aborted
+# mid-stream so one oversized URL cannot balloon memory or waste bandwidth
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+
+# Candidates whose combined size stays under this are sent inline with the
+# prompt, skipping the per-file upload round-trips of the File API
+INLINE_TOTAL_BYTES = 20 * 1024 * 1024
+
+# Async download concurrency; candidate fetches are network-bound, so they
+# overlap on one event loop while the Pillow work runs in worker threads
+MAX_CONCURRENT_DOWNLOADS = 8
+CONNECTOR_LIMIT = 32
+CONNECTOR_LIMIT_PER_HOST = 8
+
+# Keywords processed concurrently; the token bucket still paces the Gemini
+# calls inside them, so this mainly overlaps search and download latency
+KEYWORD_CONCURRENCY = 8
+
+# Downscale saved images so the longest edge is at most this many pixels
+# (0 disables). With xlarge search results the sources are often 10-20 MP;
+# draft() lets libjpeg decode at 1/2-1/8 scale so they never fully decode
+TARGET_MAX_EDGE = int(os.environ.get('MAX_EDGE', '1600'))
+
+def _normalize_image_bytes(content, max_edge=None):
+    """Normalize downloaded bytes to JPEG bytes, entirely in memory
+
+    Returns JPEG-encoded bytes, or None if the input is not a usable image.
+    Already-RGB JPEGs within the size cap pass through untouched; everything
+    else goes through the Pillow convert/re-encode path. max_edge overrides
+    the TARGET_MAX_EDGE default.
+    """
+    if max_edge is None:
+        max_edge = TARGET_MAX_EDGE
+
+    # Fast path: already an RGB JPEG that fits the edge cap, return the
+    # bytes as-is and skip the decode/re-encode entirely. Image.open only
+    # parses the header here, so checking mode and size is cheap;
+    # CMYK/grayscale JPEGs fall through to the convert path.
+    if _sniff_format(content) == 'jpeg':
         try:
-            response = requests.get(url, timeout=10)
-            if response.status_code == 200:
-                content = response.content
+            with Image.open(BytesIO(content)) as probe:
+                is_rgb_jpeg = probe.format == 'JPEG' and probe.mode == 'RGB'
+                fits = not max_edge or max(probe.size) <= max_edge
+        except Exception:
+            return None
+        if is_rgb_jpeg and fits:
+            return content
+
+    # Open with Pillow to validate, convert, and downscale if needed
+    try:
+        img = Image.open(BytesIO(content))
+
+        # Ask libjpeg for a DCT-scaled decode (1/2, 1/4, or 1/8) when the
+        # source is far larger than the target; the exact resize follows
+        if max_edge and max(img.size) > max_edge:
+            img.draft('RGB', (max_edge, max_edge))
+
+        # Convert to RGB if necessary (handles PNG, WebP, etc.)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # Create white background for transparent images
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode == 'P':
+                img = img.convert('RGBA')
+            background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        if max_edge and max(img.size) > max_edge:
+            img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        out = BytesIO()
+        img.save(out, 'JPEG', quality=90, subsampling=2, optimize=False, progressive=False)
+        return out.getvalue()
+    except Exception:
+        return None
+
+def _save_image_bytes(content, filename):
+    """Normalize downloaded bytes to a JPEG on disk
+
+    Returns the saved size in bytes, or None if the bytes are not a usable
+    image.
+    """
+    data = _normalize_image_bytes(content)
+    if data is None:
+        return None
+    with open(filename, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+async def download_image_async(session, url, filename, sem, max_retries=3):
+    """Download an image over the shared aiohttp session
+
+    Returns (ok, size) where size is the saved byte count, so callers don't
+    need to re-stat the file. The Pillow normalization runs in a worker
+    thread so it never blocks the event loop.
+    """
+    async with sem:
+        for attempt in range(max_retries):
+            try:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    response.raise_for_status()
+                    # Header-level preflight: reject error pages and
+                    # oversized bodies before reading a single chunk
+                    if headers_preclude_image(response.headers, MAX_DOWNLOAD_BYTES):
+                        return False, 0
+                    buf = bytearray()
+                    async for chunk in response.content.iter_chunked(65536):
+                        buf += chunk
+                        if len(buf) > MAX_DOWNLOAD_BYTES:
+                            log.info(f"  Image exceeded {MAX_DOWNLOAD_BYTES // (1024 * 1024)}MB cap, skipped")
+                            return False, 0
+                    content = bytes(buf)
 
                 # Validate image content size
-                if len(content) < 1024:  # Less than 1KB is suspicious
-                    if attempt < max_retries - 1:
-                        print(f"  Downloaded file too small ({len(content)} bytes), retrying...")
-                        time.sleep(1)
-                        continue
-                    else:
-                        print(f"  Downloaded file too small ({len(content)} bytes)")
-                        return False
-
-                # Try to open image with Pillow to validate and convert if needed
-                try:
-                    img = Image.open(BytesIO(content))
-
-                    # Convert to RGB if necessary (handles PNG, WebP, etc.)
-                    if img.mode in ('RGBA', 'LA', 'P'):
-                        # Create white background for transparent images
-                        background = Image.new('RGB', img.size, (255, 255, 255))
-                        if img.mode == 'P':
-                            img = img.convert('RGBA')
-                        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
-                        img = background
-                    elif img.mode != 'RGB':
-                        img = img.convert('RGB')
-
-                    # Save as JPEG
-                    img.save(filename, 'JPEG', quality=95)
-                    return True
-
-                except Exception as img_error:
+                if len(content) < 1024:
                     if attempt < max_retries - 1:
-                        print(f"  Invalid image format, retrying...")
-                        time.sleep(1)
+                        log.debug(f"  Downloaded file too small ({len(content)} bytes), retrying...")
+                        await asyncio.sleep(2 ** attempt)
                         continue
                     else:
-                        print(f"  Cannot process image: {img_error}")
-                        return False
+                        log.debug(f"  Downloaded file too small ({len(content)} bytes)")
+                        return False, len(content)
 
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"  Download attempt {attempt + 1} failed, retrying...")
-                time.sleep(1)
-            else:
-                print(f"  Download failed after {max_retries} attempts: {e}")
-    return False
-
-def evaluate_best_image(images, keyword, max_retries=3):
-    """Evaluate images using Gemini with retry logic and rate limiting"""
-    # Download images temporarily
-    temp_files = []
-    for i, img in enumerate(images):
-        url = img.get('original', img.get('link', ''))
-        temp_file = f'temp_{i}.jpg'
-        if download_image(url, temp_file, max_retries=2):
-            temp_files.append(temp_file)
-        else:
-            temp_files.append(None)
+                size = await asyncio.to_thread(_save_image_bytes, content, filename)
+                if size is not None:
+                    return True, size
+
+                if attempt < max_retries - 1:
+                    log.debug(f"  Invalid image format, retrying...")
+                    await asyncio.sleep(2 ** attempt)
+                else:
+                    log.warning(f"  Cannot process image from {url}")
+                    return False, 0
+
+            except Exception as e:
+                if attempt < max_retries - 1:
+                    log.debug(f"  Download attempt {attempt + 1} failed, retrying...")
+                    await asyncio.sleep(2 ** attempt)
+                else:
+                    log.warning(f"  Download failed after {max_retries} attempts: {e}")
+        return False, 0
+
+# Constrain evaluation replies to a JSON object with one integer field, so
+# parsing the verdict is deterministic instead of scraping prose for a number
+_VERDICT_SCHEMA = {
+    'type': 'object',
+    'properties': {'best_index': {'type': 'integer'}},
+    'required': ['best_index'],
+}
+_VERDICT_CONFIG = {'response_mime_type': 'application/json',
+                   'response_schema': _VERDICT_SCHEMA}
+
+def evaluate_best_image(candidates, keyword, max_retries=3):
+    """Pick the best of the downloaded candidates using Gemini
+
+    candidates is a list of (url, local_path) pairs for files the download
+    stage just wrote; evaluation reads those bytes back rather than fetching
+    anything over the network a second time. Returns an index into
+    candidates.
+    """
+    # Re-runs over the same search results reuse the previous verdict
+    # instead of re-spending Gemini quota; the key ties the verdict to the
+    # keyword and the exact candidate URL set
+    verdict_key = params_key({
+        'keyword': keyword,
+        'urls': sorted(url for url, _ in candidates),
+    })
+    cached_index = verdict_cache.get(verdict_key)
+    if cached_index is not None and 0 <= cached_index < len(candidates):
+        log.info(f"  Using cached verdict: candidate {cached_index}")
+        return cached_index
+
+    # Downscaled copies (~256px) are plenty for a "which one is best"
+    # judgment and keep the whole set inside the inline-parts budget; the
+    # full-resolution file stays on disk for the winner
+    candidate_bytes = []
+    for _, path in candidates:
+        with open(path, 'rb') as f:
+            b = f.read()
+        candidate_bytes.append(_normalize_image_bytes(b, max_edge=256) or b)
 
     # Prepare prompt
-    prompt = f"Here are {len(images)} images searched for the keyword '{keyword}'. Which one is the best match? Choose the index (0 to {len(images)-1}) of the best image fitting the keywor without watermark"
+    prompt = (f"Here are {len(candidates)} images searched for the keyword '{keyword}'. "
+              f"Which one is the best match? Choose the index (0 to {len(candidates) - 1}) "
+              f"of the best image fitting the keyword without watermark.")
 
-    # Upload images to Gemini
+    good = [b for b in candidate_bytes if b]
     uploaded_files = []
-    for temp_file in temp_files:
-        if temp_file:
-            uploaded_files.append(genai.upload_file(temp_file))
-            time.sleep(0.5)  # Increased delay to respect rate limits
-        else:
-            uploaded_files.append(None)
+    if sum(len(b) for b in good) < INLINE_TOTAL_BYTES:
+        # Inline parts ride along with the prompt, so the File API upload
+        # (and later delete) round-trips disappear entirely
+        image_parts = [{'mime_type': 'image/jpeg', 'data': b} for b in good]
+    else:
+        # Too large for inline parts: upload in parallel straight from
+        # memory — the File API accepts file-like objects, so the bytes
+        # never take a temp-file round-trip through disk; each call is
+        # paced by the token bucket and ex.map preserves input order so
+        # indices still line up
+        def _upload(entry):
+            i, b = entry
+            if not b:
+                return None
+            GEMINI_BUCKET.acquire()
+            try:
+                return genai.upload_file(BytesIO(b), mime_type='image/jpeg',
+                                         display_name=f'candidate_{i}.jpg')
+            except Exception as e:
+                log.warning(f"  ⚠ Failed to upload candidate {i}: {e}")
+                return None
 
-    # Add delay before generation to space out API calls
-    time.sleep(2)
+        with ThreadPoolExecutor(max_workers=5) as ex:
+            uploaded_files = list(ex.map(_upload, enumerate(candidate_bytes)))
+        image_parts = [uf for uf in uploaded_files if uf]
 
     # Generate content with retry logic
     best_index = 0
+    evaluation_ok = False
     for attempt in range(max_retries):
         try:
-            # Add delay before API call to avoid rate limiting
             if attempt > 0:
-                wait_time = 2 ** attempt  # Exponential backoff: 2s, 4s, 8s
-                print(f"  Retrying Gemini evaluation (attempt {attempt + 1}/{max_retries}) in {wait_time}s...")
+                # Full-jitter backoff: desynchronizes concurrent keyword
+                # tasks that hit the same transient error together
+                wait_time = random.uniform(0, 2 ** attempt)
+                log.info(f"  Retrying Gemini evaluation (attempt {attempt + 1}/{max_retries}) in {wait_time:.1f}s...")
                 time.sleep(wait_time)
 
-            contents = [prompt]
-            for uf in uploaded_files:
-                if uf:
-                    contents.append(uf)
+            GEMINI_BUCKET.acquire()
+            response = model.generate_content([prompt, *image_parts],
+                                              generation_config=_VERDICT_CONFIG)
 
-            response = model.generate_content(contents)
-
-            # Parse response to get the best index
-            text = response.text
+            # The schema guarantees a {"best_index": int} reply, so parsing
+            # is a single json.loads instead of scraping free-form text
             try:
-                best_index = int(text.split()[0])
-                if 0 <= best_index < len(images):
-                    break  # Success!
-                else:
-                    best_index = 0
-                    break
-            except:
+                parsed = json.loads(response.text).get('best_index')
+            except json.JSONDecodeError:
+                parsed = None
+            if isinstance(parsed, int) and 0 <= parsed < len(candidates):
+                best_index = parsed
+                evaluation_ok = True
+            else:
+                log.warning(f"  ⚠ Could not parse evaluation response, using first image")
                 best_index = 0
-                break
+            break
 
-        except Exception as e:
-            if "500" in str(e) or "Internal" in str(e):
-                if attempt < max_retries - 1:
-                    print(f"  Gemini API error (500), will retry...")
-                else:
-                    print(f"  Gemini evaluation failed after {max_retries} attempts: {e}")
-                    best_index = 0
+        except RETRYABLE_API_ERRORS as e:
+            if attempt < max_retries - 1:
+                log.info(f"  Transient Gemini error ({type(e).__name__}), will retry...")
             else:
-                print(f"  Error during Gemini evaluation: {e}")
+                log.warning(f"  Gemini evaluation failed after {max_retries} attempts: {e}")
                 best_index = 0
-                break
+        except Exception as e:
+            log.warning(f"  Error during Gemini evaluation: {e}")
+            best_index = 0
+            break
 
-    # Clean up uploaded files from Gemini
-    for uf in uploaded_files:
-        if uf:
-            try:
-                uf.delete()
-            except Exception as e:
-                print(f"  Warning: Failed to delete uploaded file: {e}")
+    # Clean up uploaded files from Gemini, fanning the deletes out the same
+    # way as the uploads
+    def _delete(uf):
+        try:
+            GEMINI_BUCKET.acquire()
+            uf.delete()
+        except Exception as e:
+            log.warning(f"  Warning: Failed to delete uploaded file: {e}")
 
-    # Clean up local temp files
-    for temp_file in temp_files:
-        if temp_file and os.path.exists(temp_file):
-            os.remove(temp_file)
+    to_delete = [uf for uf in uploaded_files if uf]
+    if to_delete:
+        with ThreadPoolExecutor(max_workers=5) as ex:
+            list(ex.map(_delete, to_delete))
 
-    # Add delay after evaluation to prevent rate limiting
-    time.sleep(3)  # Increased from 1s to 3s
+    # Only cache verdicts the model actually produced, not fallbacks
+    if evaluation_ok:
+        verdict_cache.set(verdict_key, best_index)
 
     return best_index
 
 def main():
-    # Load keywords from JSON
-    with open('keywords.json', 'r', encoding='utf-8') as f:
-        keywords_data = json.load(f)
+    # Load keywords from JSON (streamed when ijson is available)
+    keywords_data = load_keywords()
 
-    # Filter out invalid entries (like the header row)
-    keywords_data = [k for k in keywords_data if k['id'] not in ['编号', '']]
+    # Precompute each keyword's filename slug once instead of re-deriving
+    # it at every use in the pipeline
+    for k in keywords_data:
+        k['_slug'] = f"{k['id']}_{k['keyword_formatted'].replace(' ', '_')}"
 
     output_dir = 'output'
     output_candidates_dir = 'output_candidates'
     os.makedirs(output_dir, exist_ok=True)
     os.makedirs(output_candidates_dir, exist_ok=True)
+    load_processed(output_dir)
 
     # Configuration from environment variables
     use_gemini_eval = os.environ.get('USE_GEMINI_EVAL', 'false').lower() == 'true'
@@ -297,163 +588,157 @@ def main():
     # Option 1: Index-based (old method): START_INDEX=0, END_INDEX=30
     # Option 2: ID-based: PROCESS_IDS=1-1,1-5,2-1:2-10 (specific IDs or ranges)
     # Option 3: Part-based: PROCESS_PARTS=1,2,3 (process entire parts)
+    filtered_keywords, range_desc = filter_keywords(keywords_data)
 
-    process_ids_str = os.environ.get('PROCESS_IDS', None)
-    process_parts_str = os.environ.get('PROCESS_PARTS', None)
-
-    # Filter keywords based on configuration
-    if process_ids_str:
-        # ID-based filtering (e.g., "1-1,1-5,2-1:2-10")
-        selected_ids = set()
-        for id_spec in process_ids_str.split(','):
-            id_spec = id_spec.strip()
-            if ':' in id_spec:
-                # Range like "2-1:2-10"
-                start_id, end_id = id_spec.split(':')
-                start_part, start_num = map(int, start_id.split('-'))
-                end_part, end_num = map(int, end_id.split('-'))
-
-                if start_part != end_part:
-                    print(f"Warning: Range {id_spec} spans multiple parts, skipping")
-                    continue
-
-                for num in range(start_num, end_num + 1):
-                    selected_ids.add(f"{start_part}-{num}")
-            else:
-                # Single ID like "1-1"
-                selected_ids.add(id_spec)
-
-        filtered_keywords = [k for k in keywords_data if k['id'] in selected_ids]
-        range_desc = f"IDs: {process_ids_str}"
-
-    elif process_parts_str:
-        # Part-based filtering (e.g., "1,2,3")
-        parts = [p.strip() for p in process_parts_str.split(',')]
-        filtered_keywords = [k for k in keywords_data if k['id'].split('-')[0] in parts]
-        range_desc = f"Parts: {process_parts_str}"
-
-    else:
-        # Index-based filtering (old method, for backward compatibility)
-        start_index = int(os.environ.get('START_INDEX', '0'))
-        end_index = int(os.environ.get('END_INDEX', str(len(keywords_data))))
-        filtered_keywords = keywords_data[start_index:end_index]
-        range_desc = f"Index {start_index} to {end_index}"
-
-    print(f"Search Configuration:")
-    print(f"  - Image Size: {img_size}")
-    print(f"  - Image Type: {img_type}")
-    print(f"  - Number of Results: {num_results}")
+    log.info(f"Search Configuration:")
+    log.info(f"  - Image Size: {img_size}")
+    log.info(f"  - Image Type: {img_type}")
+    log.info(f"  - Number of Results: {num_results}")
     if img_color_type:
-        print(f"  - Color Type: {img_color_type}")
+        log.info(f"  - Color Type: {img_color_type}")
     if img_dominant_color:
-        print(f"  - Dominant Color: {img_dominant_color}")
+        log.info(f"  - Dominant Color: {img_dominant_color}")
     if file_type:
-        print(f"  - File Type: {file_type}")
-    print(f"  - Gemini Evaluation: {use_gemini_eval}")
-    print(f"  - Processing: {range_desc} ({len(filtered_keywords)} keywords)")
-    print(f"  - Output: Best image → 'output/', All candidates → 'output_candidates/'\n")
-
-    processed_count = 0
-    for item in filtered_keywords:
-        keyword = item['keyword_formatted']
-        keyword_id = item['id']
-
-        # Check if image already exists in output
-        final_filename = os.path.join(output_dir, f"{keyword_id}_{keyword.replace(' ', '_')}.jpg")
-        if os.path.exists(final_filename):
-            print(f"Skipping [{keyword_id}]: {keyword} (already exists in output)")
-            continue
-
-        # Create folder for candidates
-        keyword_folder = os.path.join(output_candidates_dir, f"{keyword_id}_{keyword.replace(' ', '_')}")
-        os.makedirs(keyword_folder, exist_ok=True)
-
-        print(f"Processing keyword [{keyword_id}]: {keyword}")
-        images = search_images(
-            keyword,
-            num=num_results,
-            img_size=img_size,
-            img_type=img_type,
-            img_color_type=img_color_type,
-            img_dominant_color=img_dominant_color,
-            file_type=file_type,
-            exclude_watermark=True
-        )
-        if not images:
-            print("  No images found")
-            continue
-
-        # Choose best image
-        if use_gemini_eval:
-            print("  Using Gemini to evaluate best image...")
-            best_index = evaluate_best_image(images, keyword)
-        else:
-            print("  Selecting first image (Gemini evaluation disabled)...")
-            best_index = 0
-
-        print(f"  Found {len(images)} images, downloading all...")
-
-        # Download all images to candidates folder
-        downloaded_images = []
+        log.info(f"  - File Type: {file_type}")
+    log.info(f"  - Gemini Evaluation: {use_gemini_eval}")
+    log.info(f"  - Processing: {range_desc} ({len(filtered_keywords)} keywords)")
+    log.info(f"  - Output: Best image → 'output/', All candidates → 'output_candidates/'\n")
+
+    search_kwargs = {
+        'num': num_results,
+        'img_size': img_size,
+        'img_type': img_type,
+        'img_color_type': img_color_type,
+        'img_dominant_color': img_dominant_color,
+        'file_type': file_type,
+        'exclude_watermark': True,
+    }
+
+    asyncio.run(run_pipeline(filtered_keywords, output_dir, output_candidates_dir,
+                             use_gemini_eval, search_kwargs))
+
+async def process_keyword(session, sem, item, output_dir, output_candidates_dir,
+                          use_gemini_eval, search_kwargs):
+    """Search, download, and pick the best image for one keyword
+
+    Returns True if a best image was written to the output folder.
+    """
+    keyword = item['keyword_formatted']
+    keyword_id = item['id']
+
+    # Skip completed keywords via the checkpoint set; no per-keyword stat
+    final_filename = os.path.join(output_dir, f"{item['_slug']}.jpg")
+    if keyword_id in _processed_ids:
+        log.info(f"Skipping [{keyword_id}]: {keyword} (already processed)")
+        return False
+
+    keyword_folder = os.path.join(output_candidates_dir, item['_slug'])
+
+    log.info(f"Processing keyword [{keyword_id}]: {keyword}")
+    # The search and the Gemini evaluation are blocking library calls, so
+    # run them in worker threads to keep the event loop free
+    images = await asyncio.to_thread(search_images, keyword, **search_kwargs)
+    if not images:
+        log.info("  No images found")
+        record_result(keyword_id, keyword, '', '', 'no_results')
+        return False
+
+    # Only create the candidates folder once the search produced something
+    # to put in it; no-result keywords leave no empty directories behind
+    os.makedirs(keyword_folder, exist_ok=True)
+
+    log.info(f"  Found {len(images)} images, downloading all...")
+
+    # Download all candidates concurrently; they are independent fetches
+    # against different hosts, so the round-trips overlap. Evaluation runs
+    # afterwards on the local files, so each image crosses the network once
+    tasks = []
+    async with asyncio.TaskGroup() as tg:
         for img_index, img_data in enumerate(images):
             url = img_data.get('original', img_data.get('link', ''))
-
-            # Save to candidates folder
             candidate_filename = os.path.join(keyword_folder, f"candidate_{img_index + 1}.jpg")
-
-            if download_image(url, candidate_filename):
-                # Verify the downloaded image
-                try:
-                    file_size = os.path.getsize(candidate_filename)
-                    if file_size < 1024:
-                        print(f"    ⚠ Candidate {img_index + 1} too small, skipped")
-                        os.remove(candidate_filename)
-                        continue
-
-                    # Quick validation
-                    with Image.open(candidate_filename) as img:
-                        img.verify()
-
-                    print(f"    ✓ Candidate {img_index + 1} saved ({file_size // 1024}KB)")
-                    downloaded_images.append((img_index, candidate_filename))
-                except Exception as e:
-                    print(f"    ⚠ Candidate {img_index + 1} corrupted, skipped")
-                    if os.path.exists(candidate_filename):
-                        os.remove(candidate_filename)
-                    continue
-            else:
-                print(f"    ✗ Failed to download candidate {img_index + 1}")
-
-        if not downloaded_images:
-            print(f"  ✗ No images downloaded successfully")
-            continue
-
-        # Copy best image to output folder
-        best_downloaded = None
-        for img_idx, filepath in downloaded_images:
-            if img_idx == best_index:
-                best_downloaded = filepath
-                break
-
-        # If best image failed, try fallback to other downloaded images
-        if not best_downloaded and downloaded_images:
-            best_downloaded = downloaded_images[0][1]
-            print(f"  ⚠ Best image not available, using fallback")
-
-        if best_downloaded:
-            import shutil
-            shutil.copy2(best_downloaded, final_filename)
-            print(f"  ✓ Best image copied to output: {final_filename}")
-            print(f"  ✓ All {len(downloaded_images)} candidates saved to: {keyword_folder}")
-            processed_count += 1
+            task = tg.create_task(download_image_async(session, url, candidate_filename, sem))
+            tasks.append((img_index, candidate_filename, task))
+
+    downloaded_images = []
+    for img_index, candidate_filename, task in tasks:
+        ok, file_size = task.result()
+        if ok:
+            # download_image_async already validated the content, so trust it
+            if file_size < 1024:
+                log.debug(f"    ⚠ Candidate {img_index + 1} too small, skipped")
+                os.remove(candidate_filename)
+                continue
+
+            # We wrote these bytes through Pillow ourselves, so a JPEG
+            # magic-number check is enough to catch a truncated or
+            # clobbered write without re-parsing the whole file
+            with open(candidate_filename, 'rb') as f:
+                magic = f.read(3)
+            if magic != b'\xff\xd8\xff':
+                log.warning(f"    ⚠ Candidate {img_index + 1} failed verification, skipped")
+                os.remove(candidate_filename)
+                continue
+
+            log.debug(f"    ✓ Candidate {img_index + 1} saved ({file_size // 1024}KB)")
+            downloaded_images.append((img_index, candidate_filename))
         else:
-            print(f"  ✗ Failed to save best image to output")
+            log.warning(f"    ✗ Failed to download candidate {img_index + 1}")
+
+    if not downloaded_images:
+        log.warning(f"  ✗ No images downloaded successfully")
+        record_result(keyword_id, keyword, '', '', 'download_failed')
+        return False
+
+    # Choose the best of the successfully downloaded candidates; failed
+    # downloads never reach the evaluator, so no fallback pass is needed
+    if use_gemini_eval and len(downloaded_images) > 1:
+        log.info("  Using Gemini to evaluate best image...")
+        candidates = [(images[i].get('original', images[i].get('link', '')), path)
+                      for i, path in downloaded_images]
+        best_pos = await asyncio.to_thread(evaluate_best_image, candidates, keyword)
+    else:
+        if not use_gemini_eval:
+            log.info("  Selecting first image (Gemini evaluation disabled)...")
+        best_pos = 0
+
+    img_idx, best_downloaded = downloaded_images[best_pos]
+    best_url = images[img_idx].get('original', images[img_idx].get('link', ''))
+
+    if best_downloaded and link_or_copy(best_downloaded, final_filename):
+        log.info(f"  ✓ Best image copied to output: {final_filename}")
+        log.info(f"  ✓ All {len(downloaded_images)} candidates saved to: {keyword_folder}")
+        record_result(keyword_id, keyword, best_url, final_filename, 'ok')
+        return True
+    else:
+        log.warning(f"  ✗ Failed to save best image to output")
+        record_result(keyword_id, keyword, '', '', 'copy_failed')
+        return False
 
-        # Add cooldown period every 10 processed keywords to prevent rate limiting
-        if use_gemini_eval and processed_count > 0 and processed_count % 10 == 0:
-            print(f"\n⏸️  Cooldown period: waiting 30 seconds to avoid rate limits...")
-            time.sleep(30)
-            print("✓ Resuming processing\n")
+async def run_pipeline(filtered_keywords, output_dir, output_candidates_dir,
+                       use_gemini_eval, search_kwargs):
+    """Process keywords concurrently over one shared aiohttp session
+
+    Up to KEYWORD_CONCURRENCY keywords run at once, each downloading its
+    candidates concurrently within the download semaphore; the Gemini token
+    bucket keeps the model calls paced regardless of fan-out.
+    """
+    connector = aiohttp.TCPConnector(limit=CONNECTOR_LIMIT,
+                                     limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+                                     ttl_dns_cache=300)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    keyword_sem = asyncio.Semaphore(KEYWORD_CONCURRENCY)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def bounded(item):
+            async with keyword_sem:
+                return await process_keyword(session, sem, item, output_dir,
+                                             output_candidates_dir, use_gemini_eval,
+                                             search_kwargs)
+
+        results = await asyncio.gather(*(bounded(item) for item in filtered_keywords))
+
+    log.info(f"\n✓ Done. Processed {sum(bool(r) for r in results)} keywords.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,86 @@
+"""Shared keyword-selection helpers.
+
+image_tool.py, download_images.py and evaluate_best.py all accept the same
+PROCESS_IDS / PROCESS_PARTS / START_INDEX+END_INDEX configuration; this
+module holds the single parser and filter they previously duplicated.
+"""
+import json
+import os
+import re
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Matches an ID range like "2-1:2-10"
+RANGE_RE = re.compile(r'^(\d+)-(\d+):(\d+)-(\d+)$')
+
+# Entries with these ids are header rows or blanks, never real keywords
+_INVALID_IDS = ('编号', '')
+
+def load_keywords(path='keywords.json'):
+    """Load keyword entries from JSON, dropping header rows and blanks
+
+    With ijson installed the file is stream-parsed, which avoids building
+    json.load's intermediate parse tree and discards invalid entries as
+    they go by; the filtered list itself is still materialized in full,
+    since filter_keywords needs random access for ID-based selection.
+    Without ijson, a plain json.load does the same filtering in memory.
+    """
+    if ijson is not None:
+        with open(path, 'rb') as f:
+            return [k for k in ijson.items(f, 'item') if k['id'] not in _INVALID_IDS]
+    with open(path, 'r', encoding='utf-8') as f:
+        return [k for k in json.load(f) if k['id'] not in _INVALID_IDS]
+
+def parse_id_spec(process_ids_str):
+    """Parse a PROCESS_IDS string like "1-1,1-5,2-1:2-10" into keyword IDs
+
+    Returns the IDs as a tuple, deduplicated but in the order they were
+    specified so downstream processing follows the user's enumeration.
+    """
+    selected_ids = {}
+    for id_spec in process_ids_str.split(','):
+        id_spec = id_spec.strip()
+        if not id_spec:
+            continue
+        match = RANGE_RE.match(id_spec)
+        if match:
+            start_part, start_num, end_part, end_num = map(int, match.groups())
+            if start_part != end_part:
+                print(f"Warning: Range {id_spec} spans multiple parts, skipping")
+                continue
+            for n in range(start_num, end_num + 1):
+                selected_ids[f"{start_part}-{n}"] = None
+        else:
+            selected_ids[id_spec] = None
+    return tuple(selected_ids)
+
+def filter_keywords(keywords_data):
+    """Select keywords to process based on the range environment variables
+
+    Checks PROCESS_IDS first, then PROCESS_PARTS, then falls back to
+    START_INDEX/END_INDEX slicing. Returns (filtered_keywords, range_desc).
+    """
+    process_ids_str = os.environ.get('PROCESS_IDS', None)
+    process_parts_str = os.environ.get('PROCESS_PARTS', None)
+
+    if process_ids_str:
+        # ID-based filtering (e.g., "1-1,1-5,2-1:2-10"); the id-indexed dict
+        # makes this O(selected) instead of a scan per selected ID
+        by_id = {k['id']: k for k in keywords_data}
+        selected_ids = parse_id_spec(process_ids_str)
+        filtered = [by_id[i] for i in selected_ids if i in by_id]
+        return filtered, f"IDs: {process_ids_str}"
+
+    if process_parts_str:
+        # Part-based filtering (e.g., "1,2,3")
+        parts = {p.strip() for p in process_parts_str.split(',')}
+        filtered = [k for k in keywords_data if k['id'].split('-')[0] in parts]
+        return filtered, f"Parts: {process_parts_str}"
+
+    # Index-based filtering (old method, for backward compatibility)
+    start_index = int(os.environ.get('START_INDEX', '0'))
+    end_index = int(os.environ.get('END_INDEX', str(len(keywords_data))))
+    return keywords_data[start_index:end_index], f"Index {start_index} to {end_index}"
@@ -0,0 +1,35 @@
+"""Token-bucket rate limiting for paced API calls.
+
+A bucket only blocks when its burst allowance is actually spent, so callers
+run at full speed while capacity is available instead of paying fixed
+worst-case sleeps between every call.
+"""
+import threading
+import time
+
+class TokenBucket:
+    """Thread-safe token bucket
+
+    Tokens refill continuously at rate_per_min, accumulating up to burst.
+    acquire() returns immediately while tokens remain and blocks just long
+    enough for the next token otherwise.
+    """
+    def __init__(self, rate_per_min, burst):
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)